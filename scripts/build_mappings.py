@@ -0,0 +1,40 @@
+"""
+Prebuild the TOML mapping files in data/ as faster-loading msgpack files.
+
+For every data/<distro>-<version>.toml this writes data/<distro>-<version>.msgpack (needs the
+msgpack package). When msgpack is installed, pip2sysdep loads these instead of parsing the TOML,
+as long as they are newer than the TOML file.
+
+Usage:
+    python3 scripts/build_mappings.py [data-dir]
+"""
+import os
+import sys
+import tomllib
+
+import msgpack
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+from pip2sysdep import _write_file_atomic  # noqa: E402
+
+def build_mapping(toml_path: str) -> str:
+    """Write the msgpack file for one mapping file and return its path."""
+    with open(toml_path, 'rb') as f:
+        data = tomllib.load(f)
+    path = toml_path[:-len('.toml')] + '.msgpack'
+    # Written to a temporary file first, so pip2sysdep never reads a half-written file.
+    # Readable by everyone the umask allows, like a file created with open().
+    umask = os.umask(0)
+    os.umask(umask)
+    _write_file_atomic(path, msgpack.packb(data), mode=0o666 & ~umask)
+    return path
+
+def main():
+    args = sys.argv[1:]
+    data_dir = args[0] if args else os.path.join(os.path.dirname(__file__), '..', 'data')
+    for name in sorted(os.listdir(data_dir)):
+        if name.endswith('.toml'):
+            print(build_mapping(os.path.join(data_dir, name)))
+
+if __name__ == "__main__":
+    main()
@@ -6,16 +6,95 @@ if sys.version_info < (3, 11):
 import enum
 import threading
 import os
-from typing import Dict, List, Optional, Set, Tuple
-from string import Template
-import tomllib
-import platform
-import urllib.request
-import sys
-import subprocess
+from typing import Callable, Dict, List, Optional, Set, Tuple
+import shlex
 import re
-import tomllib
+import marshal
+import functools
+import warnings
+import time
+
+
+# Parsed mapping content shared by all Pip2SysDep instances, keyed by (source, os_distro, os_version).
+# Values are (content, expiry time on the time.monotonic() clock).
+_CONTENT_CACHE: Dict[Tuple, Tuple[Dict, float]] = {}
+# One lock per cache key, so a slow download only holds up loads of the same mapping.
+# _CACHE_LOCK only guards creating these locks.
+_KEY_LOCKS: Dict[Tuple, threading.Lock] = {}
+_CACHE_LOCK = threading.Lock()
+# Seconds before content fetched from the online repository is fetched again
+_REPO_CACHE_TTL = 60.0
+
+# ID and VERSION_ID entries of /etc/os-release, with optional surrounding single or double quotes
+_OS_RELEASE_RE = re.compile(rb'^(ID|VERSION_ID)=(["\']?)(.*?)\2\s*$', re.M)
+
+@functools.cache
+def _detect_os() -> Tuple[str, str]:
+    """
+    Get the current OS distribution and version.
+
+    The result is cached, as it cannot change during the lifetime of the process.
 
+    Returns:
+        Tuple of (distribution_name, version)
+    """
+    # Try to get OS info from /etc/os-release first
+    try:
+        with open("/etc/os-release", 'rb') as f:
+            data = f.read()
+    except OSError:
+        data = b""
+    info = {m.group(1): m.group(3).decode('utf-8').strip() for m in _OS_RELEASE_RE.finditer(data)}
+    distro = info.get(b"ID", "")
+    version = info.get(b"VERSION_ID", "")
+    if distro and version:
+        return distro.lower(), version
+
+    # Fallback to platform module (imported here, as most systems have /etc/os-release)
+    import platform
+
+    system = platform.system().lower()
+    if system == "linux":
+        # Try to detect common distributions
+        if os.path.exists("/etc/debian_version"):
+            with open("/etc/debian_version") as f:
+                return "debian", f.read().strip()
+        elif os.path.exists("/etc/redhat-release"):
+            with open("/etc/redhat-release") as f:
+                return "rhel", f.read().split()[6].split('.')[0]
+
+    # Default fallback
+    return platform.system().lower(), platform.release()
+
+def _string_entries(items: List, where: str) -> List:
+    """Return the list without its non-string entries, warning about each one dropped."""
+    if all(isinstance(item, str) for item in items):
+        return items
+    for item in items:
+        if not isinstance(item, str):
+            warnings.warn(f"Ignoring non-string entry {item!r} in {where}")
+    return [item for item in items if isinstance(item, str)]
+
+def _normalize_content(content: Dict) -> Dict:
+    """
+    Drop non-string entries from the meta-group lists, with a warning, and resolve
+    ${package_manager} in the [__meta__.commands] entries.
+
+    This runs once per loaded mapping so dependency expansion can treat every meta-group item as
+    a string and commands can be used as-is. Package deps lists are only checked when a package
+    is converted, which keeps loading large mappings cheap.
+    """
+    meta = content.get('__meta__', {})
+    for name, items in meta.items():
+        if isinstance(items, list):
+            meta[name] = _string_entries(items, f"__meta__.{name}")
+    # Covers [__meta__.commands] and the older top-level install_command key
+    package_manager = meta.get('package_manager', 'apt')
+    for table in (meta.get('commands', {}), meta):
+        for name, value in table.items():
+            if isinstance(value, str) and "${package_manager}" in value:
+                table[name] = value.replace("${package_manager}", package_manager)
+    return content
 
 # Define the different sources pip2sysdep lists can be retrieved from
 class SysDepSource(enum.Enum):
@@ -32,11 +111,14 @@ class Pip2SysDep:
     def __init__(self, source: SysDepSource = SysDepSource.LOCAL, os_distro: Optional[str] = None, os_version: Optional[str] = None):
         self.source = source
         self._content = None
-        self._content_lock = threading.Lock()
+        # Expanded deps per pip package, filled by convert()
+        self._convert_cache: Dict[str, List[str]] = {}
+        # Fully expanded meta-groups, filled by _expand_deps()
+        self._expanded_groups: Dict[str, List[str]] = {}
 
         # If OS info not provided, try to detect it
         if os_distro is None or os_version is None:
-            detected_distro, detected_version = self._get_current_os_info()
+            detected_distro, detected_version = _detect_os()
             self.os_distro = os_distro or detected_distro
             self.os_version = os_version or detected_version
         else:
@@ -49,91 +131,149 @@ class Pip2SysDep:
         external_data_dir = os.path.abspath(os.path.join(os.path.dirname(__file__), '..', '..', 'data'))
         mapping_file = os.path.join(external_data_dir, f"{self.os_distro}-{self.os_version}.toml")
         if os.path.exists(mapping_file):
-            with open(mapping_file, 'rb') as f:
-                return tomllib.load(f)
+            return _load_toml_cached(mapping_file, parse=_read_mapping_file)
         raise FileNotFoundError(f"Mapping file not found: {mapping_file}")
 
     def _get_repo_content(self) -> Dict:
-        """Get content from remote repository (GitHub)."""
+        """
+        Get content from remote repository (GitHub).
+
+        The downloaded file and its ETag are kept in the user cache directory, so later runs
+        send a conditional request and reuse the cached copy on 304 Not Modified.
+        """
+        # Imported here, since urllib.request alone pulls in http.client, email and ssl
+        import gzip
+        import tomllib
+        import urllib.error
+        import urllib.request
+
         base_url = "https://raw.githubusercontent.com/autiwire/pip2sysdep/main/data"
         url = f"{base_url}/{self.os_distro}-{self.os_version}.toml"
+        cache_file = os.path.join(_get_cache_dir(), "repo", f"{self.os_distro}-{self.os_version}.toml")
+        etag_file = cache_file + ".etag"
+        headers = {"Accept-Encoding": "gzip"}
+        try:
+            with open(etag_file, 'r', encoding='utf-8') as f:
+                etag = f.read().strip()
+            if etag and os.path.exists(cache_file):
+                headers["If-None-Match"] = etag
+        except OSError:
+            pass
         try:
-            with urllib.request.urlopen(url) as response:
-                data = response.read()
-                return tomllib.loads(data.decode("utf-8"))
+            try:
+                with urllib.request.urlopen(urllib.request.Request(url, headers=headers)) as response:
+                    data = response.read()
+                    if response.headers.get("Content-Encoding") == "gzip":
+                        data = gzip.decompress(data)
+                    etag = response.headers.get("ETag")
+            except urllib.error.HTTPError as e:
+                if e.code == 304:
+                    return _load_toml_cached(cache_file)
+                raise
+            content = tomllib.loads(data.decode("utf-8"))
         except Exception as e:
             raise FileNotFoundError(f"Could not fetch mapping file from {url}: {e}")
+        if etag:
+            try:
+                _write_file_atomic(cache_file, data)
+                _write_file_atomic(etag_file, etag.encode('utf-8'))
+            except OSError:
+                pass
+        return content
 
     def _get_content(self) -> Dict:
-        """Get content with thread safety."""
-        with self._content_lock:
-            if self._content is None:
-                if self.source == SysDepSource.LOCAL:
-                    self._content = self._get_local_content()
-                elif self.source == SysDepSource.REPO:
-                    self._content = self._get_repo_content()
+        """Get content, loading it at most once per (source, distro, version) across instances."""
+        if self._content is not None:
+            return self._content
+        key = (self.source, self.os_distro, self.os_version)
+        # Plain dict reads are atomic, so the lock is only taken on a cache miss
+        entry = _CONTENT_CACHE.get(key)
+        if entry is None or entry[1] < time.monotonic():
+            with _CACHE_LOCK:
+                key_lock = _KEY_LOCKS.setdefault(key, threading.Lock())
+            with key_lock:
+                entry = _CONTENT_CACHE.get(key)
+                if entry is None or entry[1] < time.monotonic():
+                    if self.source == SysDepSource.LOCAL:
+                        content = _normalize_content(self._get_local_content())
+                        expires = float('inf')
+                    elif self.source == SysDepSource.REPO:
+                        try:
+                            content = _normalize_content(self._get_repo_content())
+                        except FileNotFoundError:
+                            if entry is None:
+                                raise
+                            # Keep using the expired copy when the refetch fails, until the next try
+                            content = entry[0]
+                        # The online mapping may be updated, so only keep it for a limited time
+                        expires = time.monotonic() + _REPO_CACHE_TTL
+                    entry = (content, expires)
+                    _CONTENT_CACHE[key] = entry
+        self._set_content(entry[0])
         return self._content
 
-    def _get_current_os_info(self) -> Tuple[str, str]:
-        """
-        Get the current OS distribution and version.
-        
-        Returns:
-            Tuple of (distribution_name, version)
-        """
-        # Try to get OS info from /etc/os-release first
-        if os.path.exists("/etc/os-release"):
-            with open("/etc/os-release") as f:
-                lines = f.readlines()
-                info = dict(line.strip().split("=", 1) for line in lines if "=" in line)
-                
-                # Remove quotes if present
-                distro = info.get("ID", "").strip('"')
-                version = info.get("VERSION_ID", "").strip('"')
-                
-                if distro and version:
-                    return distro.lower(), version
-
-        # Fallback to platform module
-        system = platform.system().lower()
-        if system == "linux":
-            # Try to detect common distributions
-            if os.path.exists("/etc/debian_version"):
-                with open("/etc/debian_version") as f:
-                    return "debian", f.read().strip()
-            elif os.path.exists("/etc/redhat-release"):
-                with open("/etc/redhat-release") as f:
-                    return "rhel", f.read().split()[6].split('.')[0]
-        
-        # Default fallback
-        return platform.system().lower(), platform.release()
-
-    def _expand_deps(self, mapping, items):
+    def _set_content(self, content: Dict) -> None:
+        """Replace the mapping content, dropping results expanded from the previous content."""
+        self._content = content
+        self._convert_cache.clear()
+        self._expanded_groups.clear()
+
+    def _expand_deps(self, meta, items):
+        """Expand meta-groups from __meta__ depth-first, using an explicit stack instead of recursion."""
         result = []
-        meta = mapping.get('__meta__', {})
-        for item in items:
-            # Expand meta-groups from __meta__ if present
-            if isinstance(item, str) and item.startswith('__') and item.endswith('__'):
-                if item in meta and isinstance(meta[item], list):
-                    result.extend(self._expand_deps({'__meta__': meta}, meta[item]))
-                    continue
+        expanded = self._expanded_groups
+        # Name -> members of every __group__ list in __meta__, so each item needs one dict lookup
+        groups = {
+            name: members for name, members in meta.items()
+            if name.startswith('__') and name.endswith('__') and isinstance(members, list)
+        }
+        # Meta-groups currently being expanded, to reject groups that include themselves
+        active = set()
+        stack = list(reversed(items))
+        while stack:
+            item = stack.pop()
+            if item is None:
+                # End marker pushed below a group's members, above its result offset and name
+                start = stack.pop()
+                group = stack.pop()
+                expanded[group] = result[start:]
+                active.discard(group)
+                continue
+            # Reuse groups that were fully expanded before
+            if item in expanded:
+                result.extend(expanded[item])
+                continue
+            members = groups.get(item)
+            if members is not None:
+                if item in active:
+                    raise ValueError(f"Meta-group {item} includes itself")
+                active.add(item)
+                stack.append(item)
+                stack.append(len(result))
+                stack.append(None)
+                stack.extend(reversed(members))
+                continue
             result.append(item)
         return result
 
-    def convert(self, pip_package: str) -> Dict[str, list]:
+    def _convert_many(self, pip_packages: List[str]) -> List[str]:
+        """Expand __always__ once plus the deps of every package into one deduped, ordered list."""
         content = self._get_content()
         meta = content.get('__meta__', {})
-        result = []
-        # Always start with __always__ if present
-        if '__always__' in meta:
-            result.extend(self._expand_deps({'__meta__': meta}, meta['__always__']))
-        # Add package-specific deps
-        pkg_deps = content.get(pip_package, {}).get('deps', [])
-        result.extend(self._expand_deps({'__meta__': meta}, pkg_deps))
-        # Remove duplicates while preserving order
-        seen = set()
-        flat = [x for x in result if not (x in seen or seen.add(x))]
-        return {'all': flat}
+        # Always start with __always__ if present, then add package-specific deps
+        items = list(meta.get('__always__', []))
+        for pkg in pip_packages:
+            items.extend(_string_entries(content.get(pkg, {}).get('deps', []), f"{pkg}.deps"))
+        # Expand everything in one go, then remove duplicates while preserving order
+        return list(dict.fromkeys(self._expand_deps(meta, items)))
+
+    def convert(self, pip_package: str) -> Dict[str, list]:
+        deps = self._convert_cache.get(pip_package)
+        if deps is None:
+            deps = self._convert_many([pip_package])
+            self._convert_cache[pip_package] = deps
+        # Hand out a copy so callers can't modify the cached list
+        return {'all': list(deps)}
 
     def convert_list(self, pip_packages: List[str]) -> Dict[str, list]:
         """
@@ -143,27 +283,27 @@ class Pip2SysDep:
             pip_packages (List[str]): List of pip package names to convert
 
         Returns:
-            Dict[str, list]: Dictionary mapping dependency types to sets of unique system packages, and 'all' to a deduped, order-preserving list
+            Dict[str, list]: Dictionary mapping 'all' to a deduped, order-preserving list of system packages
         """
-        result: Dict[str, set] = {}
-        all_flat = []
-        seen = set()
-        # Process each package
-        for pkg in pip_packages:
-            pkg_deps = self.convert(pkg)
-            for dep_type, deps in pkg_deps.items():
-                if dep_type not in result:
-                    result[dep_type] = set()
-                result[dep_type].update(deps)
-                # For 'all', preserve order and dedupe
-                for dep in deps:
-                    if dep not in seen:
-                        all_flat.append(dep)
-                        seen.add(dep)
-        # Convert all sets to sets except 'all', which is a list
-        out = {k: v for k, v in result.items()}
-        out['all'] = all_flat
-        return out
+        # Nothing requested, so nothing to install (not even __always__)
+        if not pip_packages:
+            return {'all': []}
+        return {'all': self._convert_many(pip_packages)}
+
+    def _get_command(self, command: str) -> str:
+        """Get the package manager command string for a [__meta__.commands] entry."""
+        content = self._get_content()
+        meta = content.get("__meta__", {})
+        # Prefer [__meta__.commands] table, fallback to old install_command key for backward compatibility
+        commands = meta.get('commands', {})
+        if command == 'install':
+            install_cmd = commands.get('install') or meta.get('install_command', 'apt install -y')
+        else:
+            install_cmd = commands.get(command)
+            if not install_cmd:
+                raise ValueError(f"No command '{command}' found in [__meta__.commands]")
+        # ${package_manager} was already resolved by _normalize_content()
+        return install_cmd
 
     def get_install_command(self, dependencies: Dict[str, Set[str]], command: str = 'install') -> str:
         """
@@ -176,65 +316,198 @@ class Pip2SysDep:
         Returns:
             str: The package manager command
         """
-        content = self._get_content()
-        meta = content.get("__meta__", {})
-        # Prefer [__meta__.commands] table, fallback to old install_command key for backward compatibility
-        commands = meta.get('commands', {})
-        if command == 'install':
-            install_cmd = commands.get('install') or meta.get('install_command', 'apt install -y')
-        else:
-            install_cmd = commands.get(command)
-            if not install_cmd:
-                raise ValueError(f"No command '{command}' found in [__meta__.commands]")
-        # Interpolate package manager command
-        if "${package_manager}" in install_cmd:
-            package_manager = meta.get("package_manager", "apt")
-            install_cmd = Template(install_cmd).substitute(package_manager=package_manager)
-        # Flatten all dependencies into a single list
-        all_deps = []
-        for deps in dependencies.values():
-            all_deps.extend(deps)
-        # Join dependencies with spaces
-        deps_str = " ".join(sorted(set(all_deps)))
+        install_cmd = self._get_command(command)
+        # Merge all dependencies into one set and join them with spaces
+        deps_str = " ".join(sorted(set().union(*dependencies.values())))
         # Return full command
         return f"{install_cmd} {deps_str}" if deps_str else install_cmd
 
-    def _get_current_os_info(self) -> tuple[Optional[str], Optional[str]]:
-        """Get current OS distribution and version."""
-        # This is a placeholder - in a real implementation, this would detect the OS
-        return "ubuntu", "24.04"
+    def get_install_argv(self, dependencies: Dict[str, Set[str]], command: str = 'install') -> List[str]:
+        """
+        Generate the package manager command for the dependencies as an argument list.
+
+        The result can be passed to subprocess.run() without a shell.
+
+        Args:
+            dependencies (Dict[str, Set[str]]): Dictionary of dependencies by type
+            command (str): Which command to use from [__meta__.commands] (e.g. 'install', 'update'). Default is 'install'.
+
+        Returns:
+            List[str]: The package manager command and its arguments
+        """
+        return shlex.split(self._get_command(command)) + sorted(set().union(*dependencies.values()))
+
+def _get_cache_dir() -> str:
+    """Get the per-user cache directory (honours XDG_CACHE_HOME)."""
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "pip2sysdep")
+
+def _write_file_atomic(filename: str, data: bytes, mode: Optional[int] = None) -> None:
+    """
+    Write a file via a temp file and rename, so concurrent readers never see partial content.
+
+    The file is only readable by the current user, unless a different permission mode is given.
+    """
+    import tempfile
+
+    directory = os.path.dirname(filename)
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=os.path.basename(filename) + ".", suffix=".tmp")
+    try:
+        if mode is not None:
+            os.fchmod(fd, mode)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_path, filename)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+
+# Files at least this large are decoded straight from a memory map instead of a read buffer
+_MMAP_THRESHOLD = 1024 * 1024
+
+def _read_toml_file(filename: str) -> Dict:
+    """
+    Read a TOML file into memory and parse it from the buffer.
+
+    Large files (huge pyproject.toml files in monorepos) are memory-mapped and decoded
+    directly from the mapping, which avoids holding a full bytes copy next to the text.
+    """
+    # Imported here, so runs served from the marshal cache never load the TOML parser
+    import tomllib
+
+    with open(filename, 'rb') as f:
+        fd = f.fileno()
+        # Let the kernel start prefetching the whole file (helps on NFS/FUSE mounts)
+        if hasattr(os, 'posix_fadvise'):
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_WILLNEED)
+        if os.fstat(fd).st_size >= _MMAP_THRESHOLD:
+            import mmap
+            with mmap.mmap(fd, 0, access=mmap.ACCESS_READ) as mm:
+                text = str(mm, 'utf-8')
+        else:
+            # read() loops until EOF, so short reads (FUSE/NFS) or a growing file don't truncate it
+            text = f.read().decode('utf-8')
+    return tomllib.loads(text)
+
+def _read_mapping_file(filename: str) -> Dict:
+    """
+    Read a mapping TOML file, preferring the msgpack form prebuilt by scripts/build_mappings.py.
+
+    The msgpack file next to the TOML file (needs the optional msgpack package) is only used while
+    it is at least as new as the TOML file. If it can't be read, the TOML file is parsed instead.
+    """
+    msgpack_file = filename[:-len('.toml')] + '.msgpack'
+    try:
+        import msgpack
+
+        fresh = os.stat(msgpack_file).st_mtime_ns >= os.stat(filename).st_mtime_ns
+    except (ImportError, OSError):
+        # No msgpack package or no prebuilt file
+        fresh = False
+    if fresh:
+        try:
+            return _load_msgpack_mapping(msgpack_file)
+        except (OSError, ValueError, msgpack.exceptions.UnpackException):
+            # Unreadable or damaged file
+            pass
+    return _read_toml_file(filename)
+
+def _load_msgpack_mapping(filename: str) -> Dict:
+    """Load a mapping written by scripts/build_mappings.py."""
+    import msgpack
+
+    with open(filename, 'rb') as f:
+        data = msgpack.unpackb(f.read(), raw=False)
+    if not isinstance(data, dict):
+        raise ValueError(f"Not a mapping: {filename}")
+    return data
+
+def _load_toml_cached(filename: str, parse: Optional[Callable[[str], Dict]] = None) -> Dict:
+    """
+    Load a TOML file, reusing a marshalled copy of the parsed content from earlier runs.
+
+    The marshal file is stored in the user cache directory and keyed by the file's path, mtime
+    and size, so any change to the TOML file results in a fresh parse. The marshal format can
+    differ between Python versions, so the interpreter's cache tag is part of the name too.
+    Cache write failures (read-only home, full disk, values marshal can't store) are ignored.
+
+    Args:
+        filename (str): Path to the TOML file
+        parse (Callable, optional): Function used to read the file on a cache miss (default: _read_toml_file)
+
+    Returns:
+        Dict: The parsed TOML content
+    """
+    # Imported here, as hashlib loads OpenSSL, which is noticeable in the CLI's startup time
+    import hashlib
+
+    st = os.stat(filename)
+    key = hashlib.sha1(os.path.abspath(filename).encode("utf-8")).hexdigest()
+    suffix = f".{sys.implementation.cache_tag}.marshal"
+    cache_dir = _get_cache_dir()
+    cache_path = os.path.join(cache_dir, f"{key}.{st.st_mtime_ns}.{st.st_size}{suffix}")
+    try:
+        with open(cache_path, 'rb') as f:
+            return marshal.load(f)
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+    data = (parse or _read_toml_file)(filename)
+    try:
+        # marshal only handles builtin types; TOML dates and times make this raise ValueError
+        _write_file_atomic(cache_path, marshal.dumps(data))
+        # Drop cached copies of older versions of the same file
+        for name in os.listdir(cache_dir):
+            if name.startswith(key + ".") and name.endswith(suffix) and name != os.path.basename(cache_path):
+                os.unlink(os.path.join(cache_dir, name))
+    except (OSError, ValueError):
+        pass
+    return data
+
+# VCS, URL, editable and local path prefixes (requirements that don't name an index package),
+# grouped by first character so most lines need at most one startswith() call
+_VCS_BY_FIRST = {
+    'g': ('git+',),
+    'h': ('http://', 'https://'),
+    's': ('ssh://',),
+    '-': ('-e',),
+    '.': ('./', '../'),
+    '/': ('/',),
+}
+# End of the package name: a comment, an environment marker, extras or a version specifier
+# (e.g. foo[bar]==1.2.3 ; python_version < "3.12"  # note). One compiled split is several
+# times faster than scanning for each terminator with str.find().
+_PKG_SPLIT = re.compile(r'[#;=<>!~\[ ]')
 
 def extract_pkg_name(line):
     # Skip VCS, URLs, editable installs, and local paths
-    vcs_prefixes = ('git+', 'http://', 'https://', 'ssh://', '-e', './', '../', '/')
-    if line.startswith(vcs_prefixes):
+    prefixes = _VCS_BY_FIRST.get(line[:1])
+    if prefixes and line.startswith(prefixes):
         return None
-    # Remove comments and environment markers
-    line = line.split('#', 1)[0].split(';', 1)[0].strip()
-    if not line:
-        return None
-    # Remove extras and version specifiers (e.g. foo[bar]==1.2.3)
-    pkg = re.split(r'[=<>!~\[ ]', line, 1)[0].strip()
+    # Cut at the first comment, marker, extra or specifier character in a single split
+    pkg = _PKG_SPLIT.split(line.lstrip(), 1)[0].rstrip()
     if pkg:
         return pkg
     return None
 
 def parse_requirements_file(filename):
     pkgs = []
-    with open(filename, 'r') as f:
-        for line in f:
-            line = line.strip()
-            if not line or line.startswith('#'):
-                continue
-            pkg = extract_pkg_name(line)
-            if pkg:
-                pkgs.append(pkg)
+    # Read the whole file at once; requirement files are small enough to split in memory
+    with open(filename, 'r', encoding='utf-8') as f:
+        data = f.read()
+    # Each line is stripped exactly once; extract_pkg_name's own lstrip() is then a no-op
+    for line in map(str.strip, data.splitlines()):
+        if not line or line[0] == '#':
+            continue
+        pkg = extract_pkg_name(line)
+        if pkg:
+            pkgs.append(pkg)
     return pkgs
 
 def parse_pyproject_toml(filename):
     pkgs = []
-    with open(filename, 'rb') as f:
-        data = tomllib.load(f)
+    data = _load_toml_cached(filename)
     # PEP 621
     project = data.get('project', {})
     if 'dependencies' in project:
@@ -271,6 +544,9 @@ You can combine --txt/--toml with additional package names on the command line.
 Only one of --txt or --toml can be used at a time.
 '''
 
+# Values accepted by --separator
+SEPARATORS = {'space': ' ', 'newline': '\n'}
+
 def main():
     args = sys.argv[1:]
     if '--help' in args:
@@ -288,24 +564,22 @@ def main():
     i = 0
     while i < len(args):
         arg = args[i]
-        if arg == '--local':
-            use_local = True
-        elif arg.startswith('--local='):
+        # Split '--flag=value' once instead of matching each flag's prefix separately
+        name, has_value, value = arg.partition('=')
+        if name == '--local':
             use_local = True
-            local_file = arg.split('=', 1)[1]
+            if has_value:
+                local_file = value
         elif arg == '--install':
             do_install = True
         elif arg == '--show-input':
             show_input = True
-        elif arg.startswith('--separator='):
-            val = arg.split('=', 1)[1].strip().lower()
-            if val == 'space':
-                separator = ' '
-            elif val == 'newline':
-                separator = '\n'
-            else:
+        elif name == '--separator' and has_value:
+            val = value.strip().lower()
+            if val not in SEPARATORS:
                 print("Unknown separator: {} (use 'space' or 'newline')".format(val), file=sys.stderr)
                 sys.exit(1)
+            separator = SEPARATORS[val]
         elif arg == '--txt' and i + 1 < len(args):
             txt_file = args[i + 1]
             i += 1
@@ -328,28 +602,26 @@ def main():
         print(HELP_MESSAGE, file=sys.stderr)
         sys.exit(1)
     # Deduplicate while preserving order
-    seen = set()
-    pkgs = [x for x in pkgs if not (x in seen or seen.add(x))]
+    pkgs = list(dict.fromkeys(pkgs))
     if show_input:
         for pkg in pkgs:
             print(pkg)
         sys.exit(0)
-    if use_local and local_file:
-        # Patch Pip2SysDep._get_local_content to load from the given file
-        def _get_local_content(self):
-            with open(local_file, 'rb') as f:
-                return tomllib.load(f)
-        Pip2SysDep._get_local_content = _get_local_content
     source = Pip2SysDep.Source.LOCAL if use_local else Pip2SysDep.Source.REPO
     converter = Pip2SysDep(source=source)
+    if use_local and local_file:
+        # Load the given mapping file directly instead of the one for the detected OS
+        converter._set_content(_normalize_content(_load_toml_cached(local_file)))
     result = converter.convert_list(pkgs)
     pkgs_out = result['all']
     if do_install:
-        # Get the install command and run it
-        cmd = converter.get_install_command({'all': pkgs_out})
-        print(f"Running: {cmd}")
+        import subprocess
+
+        # Get the install command and run it directly, without a shell
+        argv = converter.get_install_argv({'all': pkgs_out})
+        print(f"Running: {shlex.join(argv)}")
         try:
-            proc = subprocess.run(cmd, shell=True)
+            proc = subprocess.run(argv, check=False)
             sys.exit(proc.returncode)
         except Exception as e:
             print(f"Error running install command: {e}", file=sys.stderr)
@@ -4,17 +4,18 @@ import os
 import builtins
 import tomllib
 
-from pip2sysdep import Pip2SysDep, Source, DependencyType
+from pip2sysdep import Pip2SysDep, SysDepSource as Source
 
-# Test data directory setup
-@pytest.fixture
-def test_data_dir(tmp_path, monkeypatch):
-    """Create a temporary directory with test mapping files and patch Pip2SysDep to use it."""
-    data_dir = tmp_path / "data"
-    data_dir.mkdir(exist_ok=True)
+@pytest.fixture(autouse=True)
+def clear_content_cache(monkeypatch):
+    """Give every test an empty module-level content cache, since tests patch the loaders."""
+    monkeypatch.setattr("pip2sysdep._CONTENT_CACHE", {})
 
-    # TOML mapping as a string (no toml dependency)
-    mapping_toml = '''
+# Distributions the test mapping files are written for
+TEST_DISTROS = [("debian", "12"), ("ubuntu", "24.04"), ("fedora", "38")]
+
+# Test mapping, parsed once at import and served to every test distro
+MAPPING_DATA = tomllib.loads('''
 [__meta__]
 __always__ = [
     "python3-pip", "python3-setuptools", "python3-wheel", "python3-venv"
@@ -31,28 +32,45 @@ deps = ["__dev__", "libldap2-dev", "libsasl2-dev", "libldap-2.5-0", "libsasl2-2"
 
 [requests]
 deps = []
-'''
+''')
+
+# Test data directory setup
+@pytest.fixture(scope="session")
+def _test_data_files(tmp_path_factory):
+    """Create empty mapping files for the test distros once per session and return their directory."""
+    data_dir = tmp_path_factory.mktemp("data")
+    for distro, version in TEST_DISTROS:
+        (data_dir / f"{distro}-{version}.toml").touch()
+    return data_dir
 
-    for distro, version in [("debian", "12"), ("ubuntu", "24.04"), ("fedora", "38")]:
-        toml_path = data_dir / f"{distro}-{version}.toml"
-        with open(toml_path, "w") as f:
-            f.write(mapping_toml)
+@pytest.fixture
+def test_data_dir(_test_data_files, monkeypatch):
+    """Patch Pip2SysDep to load MAPPING_DATA for the distros in the session's test data directory."""
+    data_dir = _test_data_files
 
-    # Patch Pip2SysDep to always load from this temp data dir
+    # The files only mark which distros exist; unknown ones still raise FileNotFoundError.
+    # MAPPING_DATA is shared between tests, which is fine as long as nothing modifies it.
     def _get_local_content(self):
         mapping_file = data_dir / f"{self.os_distro}-{self.os_version}.toml"
-        with open(mapping_file, 'rb') as f:
-            return tomllib.load(f)
+        if not mapping_file.exists():
+            raise FileNotFoundError(mapping_file)
+        return MAPPING_DATA
     monkeypatch.setattr("pip2sysdep.Pip2SysDep._get_local_content", _get_local_content)
+    monkeypatch.syspath_prepend(str(data_dir.parent))
     return data_dir
 
+@pytest.fixture
+def debian12_converter(test_data_dir):
+    """A LOCAL converter for the debian 12 test mapping."""
+    return Pip2SysDep(source=Source.LOCAL, os_distro="debian", os_version="12")
+
 @pytest.fixture
 def mock_os_info(monkeypatch):
     """Mock the OS info detection."""
     def mock_get_os_info():
         return "ubuntu", "24.04"
     
-    monkeypatch.setattr("pip2sysdep._helper._get_current_os_info", mock_get_os_info)
+    monkeypatch.setattr("pip2sysdep._detect_os", mock_get_os_info)
 
 def test_init_with_defaults(mock_os_info):
     """Test initialization with default values."""
@@ -61,26 +79,27 @@ def test_init_with_defaults(mock_os_info):
     assert converter.os_distro == "ubuntu"
     assert converter.os_version == "24.04"
 
-def test_init_with_custom_values():
+@pytest.mark.parametrize("distro,version", TEST_DISTROS)
+def test_init_with_custom_values(distro, version):
     """Test initialization with custom values."""
     converter = Pip2SysDep(
         source=Source.LOCAL,
-        os_distro="debian",
-        os_version="12"
+        os_distro=distro,
+        os_version=version
     )
     assert converter.source == Source.LOCAL
-    assert converter.os_distro == "debian"
-    assert converter.os_version == "12"
+    assert converter.os_distro == distro
+    assert converter.os_version == version
 
-def test_convert_single_package(test_data_dir, monkeypatch):
+def test_convert_single_package(test_data_dir):
     """Test converting a single package."""
-    monkeypatch.syspath_prepend(test_data_dir.parent)
-    
     converter = Pip2SysDep(
         os_distro="ubuntu",
         os_version="24.04"
     )
     
+    # Order doesn't matter here, only which packages come out, each of them once.
+    # test_meta_group_expansion covers the expansion order.
     # Test package with multiple dependency types
     numpy_deps = converter.convert("numpy")['all']
     expected_numpy = [
@@ -88,30 +107,24 @@ def test_convert_single_package(test_data_dir, monkeypatch):
         "build-essential", "gcc", "g++", "make", "pkg-config", "python3-dev",
         "libopenblas-dev", "liblapack-dev", "libopenblas0", "liblapack3"
     ]
-    assert numpy_deps == expected_numpy
+    assert sorted(numpy_deps) == sorted(expected_numpy)
     
     # Test package with only system libraries (requests has no extra deps)
     requests_deps = converter.convert("requests")['all']
     expected_requests = [
         "python3-pip", "python3-setuptools", "python3-wheel", "python3-venv"
     ]
-    assert requests_deps == expected_requests
+    assert sorted(requests_deps) == sorted(expected_requests)
     
     # Test unknown package
     nonexistent_deps = converter.convert("nonexistent")['all']
-    assert nonexistent_deps == [
+    assert sorted(nonexistent_deps) == sorted([
         "python3-pip", "python3-setuptools", "python3-wheel", "python3-venv"
-    ]
+    ])
 
-def test_convert_package_list(test_data_dir, monkeypatch):
+def test_convert_package_list(debian12_converter):
     """Test converting a list of packages."""
-    monkeypatch.syspath_prepend(test_data_dir.parent)
-    
-    converter = Pip2SysDep(
-        source=Source.LOCAL,
-        os_distro="debian",
-        os_version="12"
-    )
+    converter = debian12_converter
     
     packages = ["numpy", "python-ldap", "requests"]
     deps = converter.convert_list(packages)
@@ -126,15 +139,9 @@ def test_convert_package_list(test_data_dir, monkeypatch):
     ]:
         assert pkg in all_deps
 
-def test_get_install_command(test_data_dir, monkeypatch):
+def test_get_install_command(debian12_converter):
     """Test generating install commands."""
-    monkeypatch.syspath_prepend(test_data_dir.parent)
-    
-    converter = Pip2SysDep(
-        source=Source.LOCAL,
-        os_distro="debian",
-        os_version="12"
-    )
+    converter = debian12_converter
     
     # Get dependencies
     deps = converter.convert_list(["numpy", "python-ldap"])
@@ -148,34 +155,28 @@ def test_get_install_command(test_data_dir, monkeypatch):
     for pkg in all_deps:
         assert pkg in cmd
 
-def test_thread_safety(test_data_dir, monkeypatch):
+def test_get_install_argv(debian12_converter):
+    """Test generating install commands as argument lists."""
+    converter = debian12_converter
+
+    deps = converter.convert_list(["numpy", "python-ldap"])
+    argv = converter.get_install_argv(deps)
+
+    # Same command as get_install_command, one list item per word
+    assert argv[:3] == ["apt", "install", "-y"]
+    assert argv[3:] == sorted(deps['all'])
+    assert " ".join(argv) == converter.get_install_command(deps)
+
+def test_thread_safety(debian12_converter):
     """Test thread safety of content loading."""
-    monkeypatch.syspath_prepend(test_data_dir.parent)
-    
-    import threading
-    
-    converter = Pip2SysDep(
-        source=Source.LOCAL,
-        os_distro="debian",
-        os_version="12"
-    )
-    results = []
-    
-    def worker():
-        result = converter.convert("numpy")
-        results.append(result)
-    
-    # Create multiple threads
-    threads = [threading.Thread(target=worker) for _ in range(5)]
-    
-    # Start all threads
-    for t in threads:
-        t.start()
-    
-    # Wait for all threads to complete
-    for t in threads:
-        t.join()
-    
+    from concurrent.futures import ThreadPoolExecutor
+
+    converter = debian12_converter
+
+    # Many more calls than workers, so the threads keep racing each other
+    with ThreadPoolExecutor(max_workers=5) as executor:
+        results = list(executor.map(lambda _: converter.convert("numpy"), range(64)))
+
     # All results should be identical
     assert all(r == results[0] for r in results)
     all_deps = results[0]['all']
@@ -197,32 +198,23 @@ def test_error_handling():
         )
         converter.convert("numpy")  # This should fail because the mapping file doesn't exist
 
-def test_different_distros(test_data_dir, monkeypatch):
+@pytest.mark.parametrize("distro,version", TEST_DISTROS)
+def test_different_distros(test_data_dir, distro, version):
     """Test that different distributions work correctly."""
-    monkeypatch.syspath_prepend(test_data_dir.parent)
-    
-    # Test with different distributions
-    distros = [
-        ("debian", "12"),
-        ("ubuntu", "24.04"),
-        ("fedora", "38")
-    ]
-    
-    for distro, version in distros:
-        converter = Pip2SysDep(
-            source=Source.LOCAL,
-            os_distro=distro,
-            os_version=version
-        )
-        
-        # Each distro should handle the conversion
-        deps = converter.convert("numpy")['all']
-        for pkg in [
-            "python3-pip", "python3-setuptools", "python3-wheel", "python3-venv",
-            "build-essential", "gcc", "g++", "make", "pkg-config", "python3-dev",
-            "libopenblas-dev", "liblapack-dev", "libopenblas0", "liblapack3"
-        ]:
-            assert pkg in deps
+    converter = Pip2SysDep(
+        source=Source.LOCAL,
+        os_distro=distro,
+        os_version=version
+    )
+
+    # Each distro should handle the conversion
+    deps = converter.convert("numpy")['all']
+    for pkg in [
+        "python3-pip", "python3-setuptools", "python3-wheel", "python3-venv",
+        "build-essential", "gcc", "g++", "make", "pkg-config", "python3-dev",
+        "libopenblas-dev", "liblapack-dev", "libopenblas0", "liblapack3"
+    ]:
+        assert pkg in deps
 
 def test_meta_group_expansion(monkeypatch):
     # Patch _get_local_content to provide a minimal TOML-like dict for testing
@@ -262,6 +254,21 @@ def test_recursive_meta_group(monkeypatch):
     deps = converter.convert("pkg")['all']
     assert deps == ["foo", "bar", "baz", "libx"]
 
+def test_cyclic_meta_group(monkeypatch):
+    def fake_content(self):
+        return {
+            "__meta__": {
+                "__always__": ["foo"],
+                "__dev__": ["bar", "__build__"],
+                "__build__": ["baz", "__dev__"]
+            },
+            "pkg": {"deps": ["__dev__", "libx"]}
+        }
+    monkeypatch.setattr(Pip2SysDep, "_get_local_content", fake_content)
+    converter = Pip2SysDep(os_distro="testos", os_version="1.0")
+    with pytest.raises(ValueError, match="__dev__ includes itself"):
+        converter.convert("pkg")
+
 def test_duplicate_removal(monkeypatch):
     def fake_content(self):
         return {
@@ -276,3 +283,245 @@ def test_duplicate_removal(monkeypatch):
     deps = converter.convert("pkg")['all']
     # Should not have duplicates
     assert deps == ["foo", "bar", "baz"]
+
+def test_non_string_entries_dropped(monkeypatch):
+    def fake_content(self):
+        return {
+            "__meta__": {
+                "__always__": ["foo", 1],
+                "__dev__": ["bar", {"baz": True}]
+            },
+            "pkg": {"deps": ["__dev__", None, "libx"]}
+        }
+    monkeypatch.setattr(Pip2SysDep, "_get_local_content", fake_content)
+    converter = Pip2SysDep(os_distro="testos", os_version="1.0")
+    with pytest.warns(UserWarning) as record:
+        deps = converter.convert("pkg")['all']
+    assert deps == ["foo", "bar", "libx"]
+    assert sorted(str(w.message) for w in record) == [
+        "Ignoring non-string entry 1 in __meta__.__always__",
+        "Ignoring non-string entry None in pkg.deps",
+        "Ignoring non-string entry {'baz': True} in __meta__.__dev__",
+    ]
+
+def test_package_manager_in_commands(monkeypatch):
+    def fake_content(self):
+        return {
+            "__meta__": {
+                "package_manager": "dnf",
+                "commands": {"install": "sudo ${package_manager} install -y"}
+            },
+            "pkg": {"deps": ["libx"]}
+        }
+    monkeypatch.setattr(Pip2SysDep, "_get_local_content", fake_content)
+    converter = Pip2SysDep(os_distro="testos", os_version="1.0")
+    deps = converter.convert_list(["pkg"])
+    assert converter.get_install_command(deps) == "sudo dnf install -y libx"
+
+def test_convert_list_short_inputs(monkeypatch):
+    def fake_content(self):
+        raise AssertionError("mapping should not be loaded for an empty package list")
+    monkeypatch.setattr(Pip2SysDep, "_get_local_content", fake_content)
+    converter = Pip2SysDep(os_distro="testos", os_version="1.0")
+    # Empty input returns immediately, without __always__
+    assert converter.convert_list([]) == {'all': []}
+    # A single package gives the same result as convert()
+    monkeypatch.setattr(Pip2SysDep, "_get_local_content", lambda self: {
+        "__meta__": {"__always__": ["foo"]},
+        "pkg": {"deps": ["bar"]}
+    })
+    assert converter.convert_list(["pkg"]) == converter.convert("pkg") == {'all': ["foo", "bar"]}
+
+def test_set_content_clears_caches(monkeypatch):
+    """Replacing the content drops deps expanded from the previous mapping."""
+    monkeypatch.setattr(Pip2SysDep, "_get_local_content", lambda self: {
+        "__meta__": {"__dev__": ["x"]},
+        "pkg": {"deps": ["__dev__", "y"]}
+    })
+    converter = Pip2SysDep(os_distro="testos", os_version="1.0")
+    assert converter.convert("pkg")['all'] == ["x", "y"]
+    converter._set_content({
+        "__meta__": {"__dev__": ["z"]},
+        "pkg": {"deps": ["__dev__", "w"]}
+    })
+    assert converter.convert("pkg")['all'] == ["z", "w"]
+    assert converter.convert_list(["pkg"])['all'] == ["z", "w"]
+
+def test_toml_disk_cache(tmp_path, monkeypatch):
+    """Parsed TOML is reused from the on-disk cache until the file changes."""
+    import pip2sysdep
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    toml_path = tmp_path / "mapping.toml"
+    toml_path.write_text('[pkg]\ndeps = ["foo"]\n')
+
+    assert pip2sysdep._load_toml_cached(str(toml_path)) == {"pkg": {"deps": ["foo"]}}
+    assert len(list((tmp_path / "cache" / "pip2sysdep").glob("*.marshal"))) == 1
+
+    # Unchanged file: served from the cache without parsing
+    def fail(filename):
+        raise AssertionError("TOML should not be parsed on a cache hit")
+    with monkeypatch.context() as m:
+        m.setattr(pip2sysdep, "_read_toml_file", fail)
+        assert pip2sysdep._load_toml_cached(str(toml_path)) == {"pkg": {"deps": ["foo"]}}
+
+    # Changed file: parsed again and the stale cache file replaced
+    toml_path.write_text('[pkg]\ndeps = ["foo", "bar"]\n')
+    assert pip2sysdep._load_toml_cached(str(toml_path)) == {"pkg": {"deps": ["foo", "bar"]}}
+    assert len(list((tmp_path / "cache" / "pip2sysdep").glob("*.marshal"))) == 1
+
+def test_damaged_prebuilt_mapping_falls_back_to_toml(tmp_path):
+    """An unreadable prebuilt msgpack file is ignored in favour of the TOML file."""
+    import pip2sysdep
+    toml_path = tmp_path / "mapping.toml"
+    toml_path.write_text('[pkg]\ndeps = ["foo"]\n')
+    # Newer than the TOML file, but truncated
+    (tmp_path / "mapping.msgpack").write_bytes(b"\x81\xa3pkg")
+    assert pip2sysdep._read_mapping_file(str(toml_path)) == {"pkg": {"deps": ["foo"]}}
+
+def test_repo_content_etag_cache(tmp_path, monkeypatch):
+    """Remote mappings are revalidated with If-None-Match and reused on 304 Not Modified."""
+    import io
+    import urllib.error
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    requests_seen = []
+
+    class FakeResponse(io.BytesIO):
+        headers = {"ETag": '"v1"'}
+
+    def fake_urlopen(request):
+        requests_seen.append(request)
+        if request.get_header("If-none-match") == '"v1"':
+            raise urllib.error.HTTPError(request.full_url, 304, "Not Modified", {}, None)
+        return FakeResponse(b'[pkg]\ndeps = ["foo"]\n')
+    monkeypatch.setattr("urllib.request.urlopen", fake_urlopen)
+
+    converter = Pip2SysDep(source=Source.REPO, os_distro="debian", os_version="12")
+    first = converter._get_repo_content()
+    second = converter._get_repo_content()
+    assert first == second == {"pkg": {"deps": ["foo"]}}
+    assert requests_seen[0].get_header("If-none-match") is None
+    assert requests_seen[1].get_header("If-none-match") == '"v1"'
+
+def test_repo_content_ttl(monkeypatch):
+    """Expired online content is fetched again, and kept if the refetch fails."""
+    fetched = [{"pkg": {"deps": ["v1"]}}, {"pkg": {"deps": ["v2"]}}, None]
+
+    def fake_repo_content(self):
+        content = fetched.pop(0)
+        if content is None:
+            raise FileNotFoundError("network down")
+        return content
+    monkeypatch.setattr(Pip2SysDep, "_get_repo_content", fake_repo_content)
+
+    import types
+    now = [1000.0]
+    monkeypatch.setattr("pip2sysdep.time", types.SimpleNamespace(monotonic=lambda: now[0]))
+
+    def deps():
+        converter = Pip2SysDep(source=Source.REPO, os_distro="debian", os_version="12")
+        return converter.convert("pkg")['all']
+    # Within the TTL, the content is shared without fetching again
+    assert deps() == deps() == ["v1"]
+    # Expired: fetched again
+    now[0] += 61
+    assert deps() == ["v2"]
+    # Expired again, but the fetch fails: the previous copy is kept
+    now[0] += 61
+    assert deps() == ["v2"]
+    assert fetched == []
+
+def test_content_lock_only_on_miss(monkeypatch):
+    """Loaded content is served without taking the cache lock."""
+    import pip2sysdep
+    monkeypatch.setattr(Pip2SysDep, "_get_local_content", lambda self: {"pkg": {"deps": ["foo"]}})
+    Pip2SysDep(os_distro="testos", os_version="1.0")._get_content()
+
+    class NoLock:
+        def __enter__(self):
+            raise AssertionError("lock taken on a cache hit")
+        def __exit__(self, *exc):
+            return False
+    monkeypatch.setattr(pip2sysdep, "_CACHE_LOCK", NoLock())
+    # Same instance and a new one: both hit the cache
+    converter = Pip2SysDep(os_distro="testos", os_version="1.0")
+    assert converter.convert("pkg")['all'] == ["foo"]
+    assert converter.convert_list(["pkg"])['all'] == ["foo"]
+
+def test_content_load_does_not_block_other_keys(monkeypatch):
+    """A slow load of one mapping does not hold up loading a different one."""
+    import threading
+    slow_started = threading.Event()
+    release_slow = threading.Event()
+
+    def fake_content(self):
+        if self.os_distro == "slow":
+            slow_started.set()
+            release_slow.wait(5)
+        return {"pkg": {"deps": [self.os_distro]}}
+    monkeypatch.setattr(Pip2SysDep, "_get_local_content", fake_content)
+
+    slow = threading.Thread(target=Pip2SysDep(os_distro="slow", os_version="1")._get_content)
+    slow.start()
+    try:
+        assert slow_started.wait(5)
+        fast = threading.Thread(target=Pip2SysDep(os_distro="fast", os_version="1")._get_content)
+        fast.start()
+        fast.join(2)
+        assert not fast.is_alive()
+    finally:
+        release_slow.set()
+        slow.join()
+
+def test_main_local_file(tmp_path, monkeypatch, capsys):
+    """The CLI converts packages with a mapping given by --local=file and runs --install without a shell."""
+    import subprocess
+    import sys
+    from pip2sysdep import main
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    mapping = tmp_path / "mapping.toml"
+    mapping.write_text(
+        '[__meta__]\n'
+        '__always__ = ["foo"]\n'
+        'package_manager = "dnf"\n'
+        '[__meta__.commands]\n'
+        'install = "sudo ${package_manager} install -y"\n'
+        '[pkg]\n'
+        'deps = ["bar"]\n'
+    )
+
+    monkeypatch.setattr(sys, "argv", ["pip2sysdep", f"--local={mapping}", "pkg", "--separator=space"])
+    main()
+    assert capsys.readouterr().out == "foo bar\n"
+
+    calls = []
+    def fake_run(argv, **kwargs):
+        calls.append((argv, kwargs))
+        return subprocess.CompletedProcess(argv, 0)
+    monkeypatch.setattr(subprocess, "run", fake_run)
+    monkeypatch.setattr(sys, "argv", ["pip2sysdep", f"--local={mapping}", "pkg", "--install"])
+    with pytest.raises(SystemExit) as exc:
+        main()
+    assert exc.value.code == 0
+    # Passed as an argument list, so no shell is involved
+    assert calls == [(["sudo", "dnf", "install", "-y", "bar", "foo"], {"check": False})]
+    assert capsys.readouterr().out == "Running: sudo dnf install -y bar foo\n"
+
+def test_detect_os_from_os_release(monkeypatch):
+    """ID and VERSION_ID are read from /etc/os-release, quoted or not."""
+    import io
+    import pip2sysdep
+    real_open = builtins.open
+    os_release = b'NAME="Ubuntu"\nID=Ubuntu\nID_LIKE=debian\nVERSION_ID=\'24.04\'\n'
+    def fake_open(file, *args, **kwargs):
+        if file == "/etc/os-release":
+            return io.BytesIO(os_release)
+        return real_open(file, *args, **kwargs)
+    monkeypatch.setattr(builtins, "open", fake_open)
+    pip2sysdep._detect_os.cache_clear()
+    try:
+        assert pip2sysdep._detect_os() == ("ubuntu", "24.04")
+        # Cached: later changes to the file are not picked up within a process
+        os_release = b'ID="debian"\nVERSION_ID="12"\n'
+        assert pip2sysdep._detect_os() == ("ubuntu", "24.04")
+    finally:
+        pip2sysdep._detect_os.cache_clear()